@@ -1,15 +1,20 @@
 import asyncio
 import gettext
-import json
 import logging
 import math
 import os
+import re
+from datetime import date
 
 import aioxmpp
 import aioxmpp.dispatcher
 import httpx
+import numpy as np
+import orjson
+import shapely
 from shapely.geometry import Polygon, MultiPolygon
-from geoalchemy2.shape import to_shape, from_shape
+from geoalchemy2.shape import to_shape
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -25,13 +30,29 @@ _ = translate.gettext
 SQRT2 = math.sqrt(2)
 
 
+def _polygon_coords(polygon):
+    '''Parse a "lat,lon lat,lon ..." string into an (n, 2) float array'''
+    coords = np.fromstring(polygon.replace(',', ' '), sep=' ', dtype=np.float64)
+    if coords.size % 2:
+        raise ValueError('odd number of coordinates')
+    coords = coords.reshape(-1, 2)
+    # drop the -1.0,-1.0 separator points
+    return coords[~((coords[:, 0] == -1.0) & (coords[:, 1] == -1.0))]
+
+
 class NinaXMPP:
     commands = ('register', 'unregister', 'feeds', 'list', 'help')
+    command_re = re.compile(
+        '^(' + '|'.join(commands) + r')(?:\s+(.*))?$',
+        re.IGNORECASE | re.DOTALL,
+    )
 
     def __init__(self, config):
         self.config = config
         self.logger = logging.getLogger(self.__class__.__name__)
         self.db = init_db(config['database'])
+        # parsed area geometries per event identifier, pruned on feed update
+        self.event_geometries = {}
 
     async def run(self):
         self.client = aioxmpp.PresenceManagedClient(
@@ -62,26 +83,22 @@ class NinaXMPP:
         )
 
         body = msg.body.any()
-        cbody = body.casefold()
-
-        if cbody.startswith('geo:'):
-            cbody = cbody.replace('geo:', 'register ')
-            body = cbody.replace('geo:', 'register ')
-        for cmd in self.commands:
-            ccmd = cmd.casefold()
-            if cbody == ccmd or cbody.startswith(ccmd + ' '):
-                reply.body[None] = getattr(self, cmd)(
-                    str(msg.from_.bare()),
-                    body[len(cmd) + 1:],
-                )
-                self.client.enqueue(reply)
-                return
+
+        if body.casefold().startswith('geo:'):
+            body = 'register ' + body[len('geo:'):]
+
+        match = self.command_re.match(body)
+        if match:
+            reply.body[None] = getattr(self, match.group(1).casefold())(
+                str(msg.from_.bare()),
+                match.group(2) or '',
+            )
         else:
             reply.body[None] = _(
                 'I did not understand your request. '
                 'Type "help" for a list of available commands'
             )
-            self.client.enqueue(reply)
+        self.client.enqueue(reply)
 
     async def update_feeds_task(self):
         self.logger.debug('Started update feeds task')
@@ -94,85 +111,164 @@ class NinaXMPP:
             await asyncio.sleep(self.config['check_interval'])
 
     async def update_feeds(self):
+        # only the HTTP fetches run concurrently, the session is not
+        # safe for interleaved writes
         async with httpx.AsyncClient(trust_env=False) as http_client:
-            for url in self.config['feeds']:
-                headers = {}
-                try:
-                    feed = self.db.query(Feed).filter_by(url=url).one()
-                except NoResultFound:
-                    self.logger.info(f'Updating feed {url} for the first time')
-                    feed = Feed(url=url)
-                else:
-                    self.logger.info(
-                        f'Updating feed {url} (last modified: {feed.last_modified})'
-                    )
-                    if feed.last_modified:
-                        headers['If-Modified-Since'] = feed.last_modified
-                    if feed.etag:
-                        headers['If-None-Match'] = feed.etag
-
-                try:
-                    response = await http_client.get(url, headers=headers)
-                except httpx.RequestError:
-                    self.logger.exception(f'Could not update feed {url}')
-                    continue
-
-                if response.status_code == httpx.codes.NOT_MODIFIED:
-                    continue
-
-                if httpx.codes.is_error(response.status_code):
-                    self.logger.warn(
-                        f'Error code updating feed {url}: {response.status_code}'
-                    )
-                    continue
-
-                try:
-                    content = response.json()
-                except json.JSONDecodeError as e:
-                    self.logger.warn(f'Error decoding JSON for feed {url}: {e}')
-                    continue
-
-                feed.last_modified = response.headers.get('Last-Modified')
-                feed.etag = response.headers.get('ETag')
+            results = await asyncio.gather(*(
+                self.fetch_feed(http_client, url)
+                for url in self.config['feeds']
+            ))
+
+        registrations = self.load_registrations()
+        for feed, response in results:
+            if response is None:
+                continue
+
+            if response.status_code == httpx.codes.NOT_MODIFIED:
+                continue
+
+            if httpx.codes.is_error(response.status_code):
+                self.logger.warn(
+                    f'Error code updating feed {feed.url}: {response.status_code}'
+                )
+                continue
+
+            try:
+                content = orjson.loads(response.content)
+            except orjson.JSONDecodeError as e:
+                self.logger.warn(f'Error decoding JSON for feed {feed.url}: {e}')
+                continue
+
+            last_modified = response.headers.get('Last-Modified')
+            etag = response.headers.get('ETag')
+            # skip the write if the validators did not change ("feed in
+            # self.db" is false for rows not persisted yet)
+            if (
+                feed not in self.db
+                or (last_modified, etag) != (feed.last_modified, feed.etag)
+            ):
+                feed.last_modified = last_modified
+                feed.etag = etag
                 self.db.add(feed)
-                self.send_updates_for_feed(content)
+            self.send_updates_for_feed(content, registrations)
 
         self.db.commit()
 
-    def send_updates_for_feed(self, feed):
+    async def fetch_feed(self, http_client, url):
+        '''Fetch a single feed, sending cached validator headers'''
+        headers = {}
+        try:
+            feed = self.db.query(Feed).filter_by(url=url).one()
+        except NoResultFound:
+            self.logger.info(f'Updating feed {url} for the first time')
+            feed = Feed(url=url)
+        else:
+            self.logger.info(
+                f'Updating feed {url} (last modified: {feed.last_modified})'
+            )
+            if feed.last_modified:
+                headers['If-Modified-Since'] = feed.last_modified
+            if feed.etag:
+                headers['If-None-Match'] = feed.etag
+
+        try:
+            response = await http_client.get(url, headers=headers)
+        except httpx.RequestError:
+            self.logger.exception(f'Could not update feed {url}')
+            response = None
+        return feed, response
+
+    def load_registrations(self):
+        '''Fetch all registered points once, as jids plus an R-Tree over them'''
+        rows = self.db.query(
+            Registration.jid,
+            func.ST_X(Registration.point),
+            func.ST_Y(Registration.point),
+        ).all()
+        jids = [row[0] for row in rows]
+        if not jids:
+            return jids, None
+        points = shapely.points(
+            np.array([row[1] for row in rows]),
+            np.array([row[2] for row in rows]),
+        )
+        return jids, shapely.STRtree(points)
+
+    def send_updates_for_feed(self, feed, registrations):
+        identifiers = [event['identifier'] for event in feed]
+        seen = set()
+        # chunked to stay below SQLite's limit of 999 bound variables
+        for offset in range(0, len(identifiers), 900):
+            seen.update(
+                identifier for identifier, in self.db.query(Event.id).filter(
+                    Event.id.in_(identifiers[offset:offset + 900])
+                )
+            )
+
+        messages = []
         for event in feed:
-            if not self.db.query(Event).filter_by(id=event['identifier']).one_or_none():
-                self.logger.debug(f'Found new event {event["identifier"]}')
-                self.send_updates_for_event(event)
-                self.db.add(Event(id=event['identifier']))
-
-    def send_updates_for_event(self, event):
-        for area in event['info'][0]['area']:
-            # convert string polygons to shapely MultiPolygon
+            identifier = event['identifier']
+            if identifier not in seen:
+                self.logger.debug(f'Found new event {identifier}')
+                if identifier not in self.event_geometries:
+                    self.event_geometries[identifier] = self.parse_event_areas(event)
+                areas = self.event_geometries[identifier]
+                if areas is not None:
+                    messages += self.send_updates_for_event(event, areas, registrations)
+                self.db.add(Event(id=identifier))
+                seen.add(identifier)
+
+        # enqueue in one tight loop so stanzas go out in a single write burst
+        for msg in messages:
+            self.client.enqueue(msg)
+
+        # drop cached geometries of events no longer present in the feed
+        current = {event['identifier'] for event in feed}
+        for identifier in list(self.event_geometries):
+            if identifier not in current:
+                del self.event_geometries[identifier]
+
+    def parse_event_areas(self, event):
+        '''Convert string polygons to shapely MultiPolygons, one per area.
+
+        Returns a list of dicts with the area description and the parsed
+        MultiPolygon, or None if any polygon is invalid. The geometry is
+        also buffered by the registration snapping tolerance so that
+        matching can use a plain covers test.
+        '''
+        tolerance = SQRT2 * 10 ** (-self.config['coordinate_digits'])
+        areas = []
+        info = event['info'][0]
+        for area in info['area']:
             try:
-                area['multipolygon'] = MultiPolygon(
-                    Polygon(
-                        list(map(float, point.split(',', 1)))
-                        for point in polygon.split(' ')
-                        if point != '-1.0,-1.0'
-                    )
+                multipolygon = MultiPolygon([
+                    Polygon(_polygon_coords(polygon))
                     for polygon in area['polygon']
                     if ' ' in polygon
-                )
+                ])
             except ValueError:
                 self.logger.warn(
                     'Event %s has invalid polygon',
                     event['identifier'],
                 )
-                return
+                return None
+            areas.append({
+                'areaDesc': area['areaDesc'],
+                'multipolygon': multipolygon,
+                'buffered': multipolygon.buffer(tolerance),
+            })
+        return areas
+
+    def send_updates_for_event(self, event, areas, registrations):
+        jids, tree = registrations
+        if tree is None:
+            return []
 
         matches = {}
-        for area in event['info'][0]['area']:
-            jid_query = self.db.query(Registration.jid).filter(
-                Registration.point.ST_Distance(from_shape(area['multipolygon']))
-                <= SQRT2 * 10 ** (-self.config['coordinate_digits'])
-            )
-            for jid, in jid_query:
+        for area in areas:
+            # the tree prunes by bounding box, the predicate does the exact test
+            for idx in tree.query(area['buffered'], predicate='covers'):
+                jid = jids[idx]
                 self.logger.debug(
                     'Event %s matched for JID %s',
                     event['identifier'],
@@ -180,30 +276,39 @@ class NinaXMPP:
                 )
                 matches.setdefault(jid, []).append(area)
 
-        for jid, areas in matches.items():
-            jid_registrations = self.db.query(Registration).filter_by(jid=jid).count()
-            self.send_update(
+        return [
+            self.update_message(
                 aioxmpp.JID.fromstr(jid),
                 event,
-                areas if jid_registrations > 1 else [],
+                areas if self.count_registrations(jid) > 1 else [],
             )
+            for jid, areas in matches.items()
+        ]
 
-    def send_update(self, jid, event, areas):
+    def count_registrations(self, jid, limit=2):
+        '''Count registrations of a JID, but stop counting at `limit` rows'''
+        return len(
+            self.db.query(Registration.id).filter_by(jid=jid).limit(limit).all()
+        )
+
+    def update_message(self, jid, event, areas):
+        info = event['info'][0]
         lines = [', '.join(area['areaDesc'] for area in areas)]
         lines += [
-            event['info'][0].get(x, '') for x in (
+            info.get(x, '') for x in (
                 'headline',
                 'description',
                 'instruction',
             )
         ]
-        for info in ('effective', 'expires'):
-            if info not in event['info'][0]:
+        today = date.today()
+        for key in ('effective', 'expires'):
+            if key not in info:
                 continue
 
             lines += ['%s: %s' % (
-                _(info.capitalize()),
-                reformat_date(event['info'][0][info]),
+                _(key.capitalize()),
+                reformat_date(info[key], today),
             )]
 
         msg = aioxmpp.Message(
@@ -211,7 +316,7 @@ class NinaXMPP:
             type_=aioxmpp.MessageType.CHAT,
         )
         msg.body[None] = strip_html('\n'.join(filter(None, lines)))
-        self.client.enqueue(msg)
+        return msg
 
     def register(self, jid, area):
         'Register to messages regarding a coordinate'
@@ -232,7 +337,7 @@ class NinaXMPP:
                 self.db.commit()
 
                 ret = _('Successfully registered to coordinates {0.y}, {0.x}').format(point)
-                if self.db.query(Registration).filter_by(jid=jid).count() == 1:
+                if self.count_registrations(jid) == 1:
                     return '\n'.join((
                         ret,
                         self.config['welcome_message'].format(**self.config)
@@ -266,15 +371,13 @@ class NinaXMPP:
         except (TypeError, ValueError):
             return _('Invalid coordinates: {}').format(area)
         else:
-            try:
-                registration = self.db.query(Registration).filter_by(
-                    jid=jid,
-                    point=str(point),
-                ).one()
-            except NoResultFound:
+            count = self.db.query(Registration).filter_by(
+                jid=jid,
+                point=str(point),
+            ).delete()
+            if count == 0:
                 return _('Not registered to coordinates {0.y}, {0.x}').format(point)
             else:
-                self.db.delete(registration)
                 self.db.commit()
                 return _('Successfully unregistered from coordinates {0.y}, {0.x}').format(point)
 
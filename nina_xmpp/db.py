@@ -3,6 +3,7 @@ from sqlalchemy.sql import select, func
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.event import listen
+from sqlalchemy.pool import StaticPool
 from geoalchemy2 import Geometry
 
 
@@ -12,6 +13,11 @@ Base = declarative_base()
 def _load_spatialite(dbapi_conn, connection_record):
     dbapi_conn.enable_load_extension(True)
     dbapi_conn.load_extension('mod_spatialite')
+    # WAL needs fewer fsyncs and allows concurrent readers
+    dbapi_conn.execute('PRAGMA journal_mode=WAL')
+    dbapi_conn.execute('PRAGMA synchronous=NORMAL')
+    dbapi_conn.execute('PRAGMA temp_store=MEMORY')
+    dbapi_conn.execute('PRAGMA mmap_size=268435456')
 
 
 class Registration(Base):
@@ -42,9 +48,15 @@ class Event(Base):
 
 
 def initialize(database):
-    engine = create_engine(database)
+    engine = create_engine(
+        database,
+        connect_args={'check_same_thread': False},
+        poolclass=StaticPool,
+    )
     listen(engine, 'connect', _load_spatialite)
     with engine.connect() as conn:
         conn.execute(select(func.InitSpatialMetaData(True, 'WGS84')))
     Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        conn.execute(select(func.CreateSpatialIndex('registration', 'point')))
     return sessionmaker(bind=engine)()
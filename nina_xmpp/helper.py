@@ -1,20 +1,49 @@
-import re
-from datetime import datetime, date
-from shapely.geometry import Point
+import time
+from datetime import date
+from functools import lru_cache
+from typing import NamedTuple
 
 
+_today_cache = (0, '')
+
+
+def _today_iso():
+    '''date.today().isoformat(), cached for one second'''
+    global _today_cache
+    now = int(time.time())
+    if now != _today_cache[0]:
+        _today_cache = (now, date.today().isoformat())
+    return _today_cache[1]
+
+
+class Point(NamedTuple):
+    '''Lightweight stand-in for shapely's Point
+
+    str() yields the same WKT as shapely, so stored registrations keep
+    matching.
+    '''
+    x: float
+    y: float
+
+    def __str__(self):
+        return f'POINT ({self.x} {self.y})'
+
+
+@lru_cache(maxsize=4096)
 def parse_area(area, ndigits):
+    # scale and round to an integer, which is a much shorter C path than
+    # round() with a digit count
+    scale = 10.0 ** ndigits
     lon, lat = (
-        round(float(x), ndigits)
-        for x in re.split(r'[, ]+', area, 1)
+        round(float(x) * scale) / scale
+        for x in area.replace(',', ' ').split(None, 1)
     )
     return Point(lat, lon)
 
 
-def reformat_date(isodate):
-    d = datetime.fromisoformat(isodate)
-    return d.strftime(
-        '%d.%m.%Y %H:%M'
-        if d.date() != date.today()
-        else '%H:%M'
-    )
+def reformat_date(isodate, today=None):
+    # NINA timestamps are fixed-format ISO-8601, so both output forms
+    # are plain rearrangements of the input string
+    if isodate[:10] == (today.isoformat() if today else _today_iso()):
+        return isodate[11:16]
+    return f'{isodate[8:10]}.{isodate[5:7]}.{isodate[:4]} {isodate[11:16]}'
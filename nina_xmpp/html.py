@@ -1,26 +1,15 @@
-from html.parser import HTMLParser
+import re
+from html import unescape
 
 
-class LinebreakParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.convert_charrefs = True
-        self.strict = False
-        self._buf = []
-
-    def handle_starttag(self, tag, attrs):
-        if tag == 'br':
-            self._buf.append('\n')
-
-    def handle_data(self, data):
-        self._buf.append(data)
-
-    def close(self):
-        super().close()
-        return "".join(self._buf)
+_BR_RE = re.compile(r'<br\s*/?>', re.IGNORECASE)
+_TAG_RE = re.compile(r'<[^>]+>')
 
 
 def strip_html(text):
-    parser = LinebreakParser()
-    parser.feed(text)
-    return parser.close()
+    '''Strip HTML tags from text, keeping <br> as line break'''
+    # most alert fields are plain text, check for that before running
+    # any substitution
+    if '<' not in text:
+        return unescape(text) if '&' in text else text
+    return unescape(_TAG_RE.sub('', _BR_RE.sub('\n', text)))